@@ -0,0 +1,222 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.widgets import CheckButtons
+
+from TinkerBolusEngine import agp_percentiles, bg_metrics, get_insulin_kernel
+from TinkerBolusData import RecordCache, WindowData, default_mongodb_uri, open_source
+from TinkerBolusBatch import day_what_ifs, load_records, scenario_arg, split_days
+
+# Many days stacked by time of day, as an AGP (ambulatory glucose profile): percentile bands of the original BG and of
+# what-if scenarios.  For example, every weekday of the last 90 days, against bolusing 15 minutes earlier for meals:
+#   python TinkerBolusAGP.py --last 90 --days weekdays --scenario early=shift:meal:-15
+# Each curve's days x samples matrix is cached as a memory-mapped .npy file, so reopening the same range is instant.
+# The individual days ("Days" checkbox) are decimated to the plot's width in pixels whenever it's zoomed or panned.
+
+weekday_names = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+day_sets = dict(all=range(7), weekdays=range(5), weekends=range(5, 7))
+percentiles = (5, 25, 50, 75, 95)
+colors = ['tab:blue', 'tab:orange', 'tab:green', 'tab:red', 'tab:purple', 'tab:brown']
+matrix_version = 2 # changes when the curves are computed differently, so cached matrices from before aren't used
+
+def weekdays_arg(spec):
+    # 'all', 'weekdays', 'weekends' or a comma-separated list such as 'mon,wed,fri'
+    if spec in day_sets:
+        return sorted(day_sets[spec])
+    try:
+        return sorted(weekday_names.index(name.strip().lower()[:3]) for name in spec.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Unrecognized days: ' + spec)
+
+def day_curves(dayStart, records, prior_records, params, scenarios, grid):
+    # the original and what-if BG for one day on the time-of-day grid (minutes after local midnight), one row per
+    # curve, with nan where the day has no data; runs in a worker process
+    curves = np.full((1 + len(scenarios), np.size(grid)), np.nan)
+    try:
+        data = WindowData(records, params['minBolus_to_load'], params['BG_interval_minutes'], prior_records)
+    except (IndexError, ValueError):
+        return curves   # no CGM data for this day
+    if np.size(data.x_BG) < 2:
+        return curves
+    kernel = get_insulin_kernel(params['tp'], params['td'], params['BG_interval_minutes'])
+    x = data.x_BG + (data.t0 - np.datetime64(dayStart, 'ms'))/np.timedelta64(60, 's')
+    ys = [data.y_BG] + day_what_ifs(data, prior_records, kernel, params['isf'], scenarios)
+    for i, y in enumerate(ys):
+        curves[i] = np.interp(grid, x, y, left=np.nan, right=np.nan)
+    return curves
+
+def matrix_path(args, days):
+    # keyed on the source's data_key(), so re-exported files don't reuse a matrix computed from the old ones
+    source = open_source(args.source, args.cache_dir)
+    try:
+        data_key = source.data_key()
+    finally:
+        source.close()
+    key = json.dumps(dict(version=matrix_version, source=data_key, days=[day.isoformat() for day in days], utcoffset=args.utcoffset, isf=args.isf, tp=args.tp,
+                          td=args.td, min_bolus=args.min_bolus, interval=args.interval,
+                          scenarios=[(scenario.name, scenario.rules) for scenario in args.scenario]))
+    return os.path.join(args.cache_dir, 'agp', hashlib.sha1(key.encode()).hexdigest()[:16] + '.npy')
+
+def load_matrix(args, days, grid):
+    # (curves, days, samples) float32 matrix, memory-mapped from the cache when it's there.  Ranges that include days
+    # which haven't fully passed aren't cached, since their data can still change.
+    path = matrix_path(args, days)
+    if not args.no_cache and os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+
+    dayStarts = [datetime.datetime.combine(day, datetime.time()) - datetime.timedelta(hours=args.utcoffset) for day in days]
+    dayStop = dayStarts[-1] + datetime.timedelta(days=1)
+    records = load_records(args, dayStarts[0] - datetime.timedelta(minutes=args.td), dayStop)
+    day_records, prior_records = split_days(records, dayStarts, args.td)
+    params = dict(minBolus_to_load=args.min_bolus, BG_interval_minutes=args.interval, tp=args.tp, td=args.td, isf=args.isf)
+
+    settled = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(minutes=RecordCache.settle_minutes)
+    cache = not args.no_cache and dayStop <= settled
+    shape = (1 + len(args.scenario), len(days), np.size(grid))
+    if cache:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp.npy'.format(path[:-4], os.getpid())
+        matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+    else:
+        matrix = np.empty(shape, dtype=np.float32)
+
+    if args.workers == 1:
+        results = map(day_curves, dayStarts, day_records, prior_records, repeat(params), repeat(args.scenario), repeat(grid))
+        for i, curves in enumerate(results):
+            matrix[:, i] = curves
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            results = executor.map(day_curves, dayStarts, day_records, prior_records, repeat(params), repeat(args.scenario), repeat(grid),
+                                   chunksize=max(1, len(days)//(4*args.workers)))
+            for i, curves in enumerate(results):
+                matrix[:, i] = curves
+
+    if not cache:
+        return matrix
+    matrix.flush()
+    del matrix
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+def decimate(x, Y, x_min, x_max, bins):
+    # Level of detail for drawing the rows of Y against x between x_min and x_max: when there are more than 2*bins samples
+    # in view, each bin is reduced to its min and max (drawn as a vertical stroke), which looks the same at one bin per
+    # pixel.  Returns (x, Y) with the same number of rows.
+    lo = max(np.searchsorted(x, x_min) - 1, 0)
+    hi = min(np.searchsorted(x, x_max, side='right') + 1, np.size(x))
+    if hi - lo <= 2*bins:
+        return x[lo:hi], Y[:, lo:hi]
+    starts = np.unique(np.linspace(lo, hi, bins + 1).astype(int)[:-1])
+    window = np.asarray(Y[:, lo:hi])
+    lows = np.fmin.reduceat(window, starts - lo, axis=1)
+    highs = np.fmax.reduceat(window, starts - lo, axis=1)
+    x_bins = (x[starts] + x[np.append(starts[1:], hi) - 1])/2
+    return np.repeat(x_bins, 2), np.stack([lows, highs], axis=-1).reshape(np.shape(Y)[0], -1)
+
+class AGPView:
+    # The AGP figure: 5-95% and 25-75% bands and the median for each curve (original first), optional individual days
+
+    def __init__(self, grid, matrix, names, title):
+        self.grid = grid
+        self.matrix = matrix
+        self.fig, self.ax = plt.subplots(figsize=(10,6))
+        self.fig.set_facecolor('lightgrey')
+        self.fig.subplots_adjust(bottom=0.15)
+
+        bands = agp_percentiles(matrix, percentiles)
+        for i, name in enumerate(names):
+            color = colors[i % len(colors)]
+            p5, p25, p50, p75, p95 = bands[i]
+            metrics = bg_metrics(np.asarray(matrix[i])[~np.isnan(matrix[i])])
+            if i == 0:   # the outer band only for the original, to keep the comparison readable
+                self.ax.fill_between(grid, p5, p95, color=color, alpha=0.12, linewidth=0)
+            self.ax.fill_between(grid, p25, p75, color=color, alpha=0.25 if i == 0 else 0.15, linewidth=0)
+            self.ax.plot(grid, p50, color=color, linewidth=2, linestyle='-' if i == 0 else '--',
+                         label='{} (TIR {:.0%}, <70 {:.0%}, GMI {:.1f})'.format(name, metrics['tir'], metrics['tbr'], metrics['gmi']))
+
+        self.ax.axhline(y=70, color='g', linestyle='-', linewidth=.5, zorder=0)
+        self.ax.axhline(y=180, color='g', linestyle='-', linewidth=.5, zorder=0)
+        self.ax.axhspan(70, 180, color='g', alpha=0.06)
+        self.ax.set_xlim(0, 1440)
+        self.ax.set_xticks(np.arange(0, 1441, 120))
+        self.ax.set_xticklabels(['{:02d}:00'.format(h % 24) for h in range(0, 25, 2)])
+        self.ax.set_xlabel('Time of day')
+        self.ax.set_ylabel('BG (mg/dL)')
+        self.ax.set_title(title)
+        self.ax.grid(True)
+        self.ax.legend(loc='upper right', fontsize=8)
+
+        self.days = LineCollection([], colors='grey', linewidths=0.5, alpha=0.3, zorder=0.5)
+        self.days.set_visible(False)
+        self.ax.add_collection(self.days)
+        self.axdays = self.fig.add_axes([0.02, 0.02, 0.08, 0.05])
+        self.days_check = CheckButtons(self.axdays, ['Days'], [False])
+        self.days_check.on_clicked(self.toggle_days)
+        self.ax.callbacks.connect('xlim_changed', self.update_days)
+
+    def toggle_days(self, label):
+        self.days.set_visible(self.days_check.get_status()[0])
+        self.update_days()
+        self.fig.canvas.draw_idle()
+
+    def update_days(self, *args):
+        # the original BG of every day, decimated to the current view (only while they're shown)
+        if not self.days.get_visible():
+            return
+        x_min, x_max = self.ax.get_xlim()
+        bins = max(1, int(self.ax.bbox.width))
+        x, Y = decimate(self.grid, self.matrix[0], x_min, x_max, bins)
+        self.days.set_segments(np.stack(np.broadcast_arrays(x, Y), axis=-1))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plot an AGP of many days by time of day, with what-if scenarios.')
+    parser.add_argument('--start', help='first day (YYYY-MM-DD, local time)')
+    parser.add_argument('--stop', help='last day, inclusive (YYYY-MM-DD, local time; default yesterday)')
+    parser.add_argument('--last', type=int, help='number of days ending with --stop, instead of --start')
+    parser.add_argument('--days', type=weekdays_arg, default=weekdays_arg('all'), help="all, weekdays, weekends or e.g. 'mon,wed,fri'")
+    parser.add_argument('--scenario', action='append', default=[], type=scenario_arg, help="name=rules, e.g. 'early=shift:meal:-15' (repeatable)")
+    parser.add_argument('--source', '--uri', default=default_mongodb_uri, help="MongoDB URI, Nightscout export files (comma-separated, or a directory) or 'synthetic[:seed=1,...]'")
+    parser.add_argument('--utcoffset', type=int, default=-6, help='UTC offset of local time (hr)')
+    parser.add_argument('--isf', type=float, default=200, help='ISF (mg/dL/U)')
+    parser.add_argument('--tp', type=float, default=75, help='insulin activity peak (minutes)')
+    parser.add_argument('--td', type=float, default=360, help='insulin duration (minutes)')
+    parser.add_argument('--min-bolus', type=float, default=0.0, help='ignore boluses at or below this size (U)')
+    parser.add_argument('--interval', type=float, default=5, help='BG interval (minutes)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (1 to run in-process)')
+    parser.add_argument('--output', help='save the plot to this file instead of showing it')
+    parser.add_argument('--offline', action='store_true', help='use the local cache only')
+    parser.add_argument('--no-cache', action='store_true', help='always query the source and skip the local caches')
+    parser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser('~'), '.tinkerbolus'))
+    args = parser.parse_args(argv)
+    if args.offline and args.no_cache:
+        parser.error('--offline needs the local cache; leave out --no-cache')
+    if (args.start is None) == (args.last is None):
+        parser.error('give either --start or --last')
+
+    lastDay = datetime.date.fromisoformat(args.stop) if args.stop else datetime.date.today() - datetime.timedelta(days=1)
+    firstDay = lastDay - datetime.timedelta(days=args.last - 1) if args.last else datetime.date.fromisoformat(args.start)
+    days = [firstDay + datetime.timedelta(days=i) for i in range((lastDay - firstDay).days + 1)]
+    days = [day for day in days if day.weekday() in args.days]
+    if len(days) == 0:
+        parser.error('no days selected')
+
+    grid = np.arange(0, 1440, args.interval)
+    matrix = load_matrix(args, days, grid)
+    with_data = np.count_nonzero(np.any(~np.isnan(matrix[0]), axis=1))
+    title = 'AGP: {} to {}, {} days with data'.format(days[0].isoformat(), days[-1].isoformat(), with_data)
+    view = AGPView(grid, matrix, ['original'] + [scenario.name for scenario in args.scenario], title)
+    if args.output:
+        view.fig.savefig(args.output)
+    else:
+        plt.show()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import csv
+import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from TinkerBolusEngine import Scenario, bg_metrics, get_insulin_kernel, what_if
+from TinkerBolusData import RecordCache, WindowData, default_mongodb_uri, open_source
+
+# Headless what-if runs over a range of days, without the GUI.  For example, to compare the original BG against
+# bolusing 15 minutes earlier for meals, and against 10% less insulin, for every day in September:
+#   python TinkerBolusBatch.py --start 2023-09-01 --stop 2023-09-30 --scenario early=shift:meal:-15 --scenario less=scale:all:0.9 --output september.csv
+# See TinkerBolusEngine.Scenario for the rule syntax.  Days are simulated in parallel on a process pool.
+
+columns = ['date', 'scenario', 'samples', 'mean', 'sd', 'min', 'max', 'gmi', 'tir', 'tbr', 'tar']
+
+def split_days(records, dayStarts, td):
+    # each day's records, and the records from the td before it (whose insulin is still acting after midnight).
+    # select() excludes its end points, so start each day 1 ms early to keep samples exactly at midnight.
+    day_records = [records.select(dayStart - datetime.timedelta(milliseconds=1), dayStart + datetime.timedelta(days=1)) for dayStart in dayStarts]
+    prior_records = [records.select(dayStart - datetime.timedelta(minutes=td), dayStart) for dayStart in dayStarts]
+    return day_records, prior_records
+
+def day_what_ifs(data, prior_records, kernel, isf, scenarios):
+    # the BG of a day's window under each scenario.  The boluses from the td before the window count too (with the
+    # scenario applied to them as well), and so do the carbs then, for telling meal boluses from corrections.
+    prior_carb_times, _ = prior_records.carb_entries()
+    x_bolus = np.concatenate([data.x_prior_bolus, data.x_bolus])
+    z_bolus = np.concatenate([data.z_prior_bolus, data.z_bolus])
+    x_carb = np.concatenate([(prior_carb_times - data.t0)/np.timedelta64(60, 's'), data.x_carb])
+    return [what_if(kernel, data.x_BG, data.y_BG, x_bolus, z_bolus, x_carb, isf, scenario) for scenario in scenarios]
+
+def simulate_day(day, records, prior_records, params, scenarios):
+    # metrics rows (original plus one per scenario) for one day; runs in a worker process
+    try:
+        data = WindowData(records, params['minBolus_to_load'], params['BG_interval_minutes'], prior_records)
+    except (IndexError, ValueError):
+        return []   # no CGM data for this day
+    if np.size(data.x_BG) < 2:
+        return []
+    kernel = get_insulin_kernel(params['tp'], params['td'], params['BG_interval_minutes'])
+    rows = [dict(date=day, scenario='original', **bg_metrics(data.y_BG))]
+    for scenario, y in zip(scenarios, day_what_ifs(data, prior_records, kernel, params['isf'], scenarios)):
+        rows.append(dict(date=day, scenario=scenario.name, **bg_metrics(y)))
+    return rows
+
+def scenario_arg(spec):
+    try:
+        return Scenario.parse(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def load_records(args, timeStart, timeStop):
+    # one fetch for the whole range (the cache only queries the source for days it doesn't have; local sources skip it)
+    source = open_source(args.source, args.cache_dir)
+    try:
+        if args.no_cache or source.local:
+            return source.query(timeStart, timeStop).sorted()
+        return RecordCache(args.cache_dir, source.name).get(timeStart, timeStop, None if args.offline else source.query, args.offline)
+    finally:
+        source.close()
+
+def write_rows(path, rows):
+    if path.endswith('.parquet'):
+        import pandas   # optional; only needed for parquet output
+        pandas.DataFrame(rows, columns=columns).to_parquet(path, index=False)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def print_summary(rows, scenario_names):
+    print('{:<16}{:>6}{:>8}{:>8}{:>8}{:>8}{:>8}'.format('scenario', 'days', 'mean', 'GMI', 'TIR%', '<70%', '>180%'))
+    for name in scenario_names:
+        day_rows = [row for row in rows if row['scenario'] == name]
+        if len(day_rows) == 0:
+            continue
+        average = lambda key: np.mean([row[key] for row in day_rows])
+        print('{:<16}{:>6}{:>8.1f}{:>8.2f}{:>8.1f}{:>8.1f}{:>8.1f}'.format(name, len(day_rows), average('mean'), average('gmi'),
+                                                                   100*average('tir'), 100*average('tbr'), 100*average('tar')))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute what-if BG curves and daily metrics over a range of days.')
+    parser.add_argument('--start', required=True, help='first day (YYYY-MM-DD, local time)')
+    parser.add_argument('--stop', required=True, help='last day, inclusive (YYYY-MM-DD, local time)')
+    parser.add_argument('--scenario', action='append', default=[], type=scenario_arg, help="name=rules, e.g. 'early=shift:meal:-15' (repeatable)")
+    parser.add_argument('--source', '--uri', default=default_mongodb_uri, help="MongoDB URI, Nightscout export files (comma-separated, or a directory) or 'synthetic[:seed=1,...]'")
+    parser.add_argument('--utcoffset', type=int, default=-6, help='UTC offset of local time (hr)')
+    parser.add_argument('--isf', type=float, default=200, help='ISF (mg/dL/U)')
+    parser.add_argument('--tp', type=float, default=75, help='insulin activity peak (minutes)')
+    parser.add_argument('--td', type=float, default=360, help='insulin duration (minutes)')
+    parser.add_argument('--min-bolus', type=float, default=0.0, help='ignore boluses at or below this size (U)')
+    parser.add_argument('--interval', type=float, default=5, help='BG interval (minutes)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (1 to run in-process)')
+    parser.add_argument('--output', help='write per-day rows to this .csv or .parquet file')
+    parser.add_argument('--offline', action='store_true', help='use the local cache only')
+    parser.add_argument('--no-cache', action='store_true', help='always query the source and skip the local cache')
+    parser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser('~'), '.tinkerbolus'))
+    args = parser.parse_args(argv)
+    if args.offline and args.no_cache:
+        parser.error('--offline needs the local cache; leave out --no-cache')
+    if args.output and args.output.endswith('.parquet'):
+        try:
+            import pandas
+        except ImportError:
+            parser.error('.parquet output needs pandas (and pyarrow); use .csv instead')
+
+    firstDay = datetime.date.fromisoformat(args.start)
+    lastDay = datetime.date.fromisoformat(args.stop)
+    days = [firstDay + datetime.timedelta(days=i) for i in range((lastDay - firstDay).days + 1)]
+    dayStarts = [datetime.datetime.combine(day, datetime.time()) - datetime.timedelta(hours=args.utcoffset) for day in days]
+    dayStop = dayStarts[-1] + datetime.timedelta(days=1)
+
+    records = load_records(args, dayStarts[0] - datetime.timedelta(minutes=args.td), dayStop)
+    day_records, prior_records = split_days(records, dayStarts, args.td)
+    params = dict(minBolus_to_load=args.min_bolus, BG_interval_minutes=args.interval, tp=args.tp, td=args.td, isf=args.isf)
+    day_labels = [day.isoformat() for day in days]
+
+    if args.workers == 1:
+        results = map(simulate_day, day_labels, day_records, prior_records, repeat(params), repeat(args.scenario))
+        rows = [row for day_rows in results for row in day_rows]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            results = executor.map(simulate_day, day_labels, day_records, prior_records, repeat(params), repeat(args.scenario),
+                                   chunksize=max(1, len(days)//(4*args.workers)))
+            rows = [row for day_rows in results for row in day_rows]
+
+    if args.output:
+        write_rows(args.output, rows)
+    print_summary(rows, ['original'] + [scenario.name for scenario in args.scenario])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import matplotlib
+matplotlib.use('Agg')  # headless; must be selected before TinkerBolus imports pyplot
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.backend_bases import MouseEvent
+
+import TinkerBolus
+from TinkerBolusData import SyntheticSource, synthetic_records
+
+# Headless benchmarks of the TinkerBolus simulation and interaction hot paths, on synthetic data of a chosen size.
+# Startup (imports, the window appearing, the first window loaded and drawn) is timed in fresh processes.
+# Results are written as JSON so runs can be compared between commits, e.g.
+#   python TinkerBolusBenchmark.py --span-hours 24 --boluses 100 --output before.json
+
+class SyntheticInteractor(TinkerBolus.BGInteractor):
+    # BGInteractor on a SyntheticSource (no MongoDB or network), with bolus_count boluses per window on average
+    prefetch = False
+    sgv_interval_minutes = 5
+    bolus_count = 24
+    seed = 0
+
+    def __init__(self, minBolus_to_load=0.0):
+        source = SyntheticSource(self.seed, self.sgv_interval_minutes, self.bolus_count*24*60/self.timespan_minutes)
+        super().__init__(source, minBolus_to_load)
+
+def time_calls(fn, repeat):
+    # seconds per call (min, median and mean over repeat calls)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return dict(min=min(times), median=float(np.median(times)), mean=float(np.mean(times)), repeat=repeat)
+
+@contextlib.contextmanager
+def deferred_draws(canvas):
+    # Agg's draw_idle() draws right away; within this it does nothing, so what asks for a redraw is timed without the draw
+    canvas.draw_idle = lambda *args, **kwargs: None
+    try:
+        yield
+    finally:
+        del canvas.draw_idle
+
+def bolus_event(bgi, name, ind, dx=0, button=None):
+    # mouse event at bolus ind, moved dx pixels to the right
+    x, y = bgi.ax.transData.transform((bgi.x_bolus[ind], bgi.y_bolus[ind]))
+    return MouseEvent(name, bgi.canvas, x + dx, y, button=button)
+
+def scripted_drag(bgi, ind, events):
+    # press on bolus ind, drag it right one pixel per move event, and release
+    press = bolus_event(bgi, 'button_press_event', ind, button=1)
+    moves = [bolus_event(bgi, 'motion_notify_event', ind, dx, button=1) for dx in range(1, events + 1)]
+    release = bolus_event(bgi, 'button_release_event', ind, events, button=1)
+    bgi.on_button_press(press)
+    start = time.perf_counter()
+    for move in moves:
+        bgi.on_mouse_move(move)
+    move_time = time.perf_counter() - start
+    bgi.on_button_release(release)
+    return move_time
+
+def live_updates(bgi, count):
+    # count successive live updates of one SGV each, following on from the loaded window
+    start = bgi.live_after['sgv']
+    records = synthetic_records(start, start + datetime.timedelta(minutes=count*bgi.sgv_interval_minutes), bgi.sgv_interval_minutes, 0, 0, bgi.seed, None)
+    return iter([records.take([i], []) for i in range(np.size(records.sgv_times))])
+
+# Run in a fresh interpreter by measure_startup(), so imports are timed cold.  Times are from the start of the script.
+startup_script = """
+import json, sys, time
+start = time.perf_counter()
+import matplotlib
+matplotlib.use('Agg')
+import TinkerBolusBenchmark
+imported = time.perf_counter()
+
+class StartupInteractor(TinkerBolusBenchmark.SyntheticInteractor):
+    ready = None
+    def load(self, *args):
+        if self.ready is None:
+            self.ready = time.perf_counter() # the figure and widgets exist; the load is next
+        super().load(*args)
+
+config = json.loads(sys.argv[1])
+StartupInteractor.timespan_minutes = 60*config['span_hours']
+StartupInteractor.bolus_count = config['boluses']
+bgi = StartupInteractor()
+loaded = time.perf_counter()
+bgi.canvas.draw()
+drawn = time.perf_counter()
+print(json.dumps(dict(imports=imported - start, window=bgi.ready - start, loaded=loaded - start, first_draw=drawn - start,
+                      modules=[m for m in ('pymongo', 'certifi', 'scipy') if m in sys.modules])))
+"""
+
+def measure_startup(args):
+    # ({stage: timing dict}, heavy modules imported) over args.startup_runs fresh processes.  'process' includes
+    # starting Python itself; the rest are from the start of the script (see startup_script).
+    times = {}
+    modules = []
+    for i in range(args.startup_runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', startup_script, json.dumps(dict(span_hours=args.span_hours, boluses=args.boluses))],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout
+        process = time.perf_counter() - start
+        stages = json.loads(output.strip().splitlines()[-1])
+        modules = stages.pop('modules')
+        for name, value in dict(stages, process=process).items():
+            times.setdefault(name, []).append(value)
+    return {name: dict(min=min(t), median=float(np.median(t)), mean=float(np.mean(t)), repeat=len(t)) for name, t in times.items()}, modules
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    SyntheticInteractor.timespan_minutes = 60*args.span_hours
+    SyntheticInteractor.timespanmax_minutes = max(SyntheticInteractor.timespanmax_minutes, 60*args.span_hours)
+    SyntheticInteractor.sgv_interval_minutes = args.sgv_interval
+    SyntheticInteractor.bolus_count = args.boluses
+    SyntheticInteractor.seed = args.seed
+    SyntheticInteractor.instrument = args.trace is not None
+
+    start = time.perf_counter()
+    bgi = SyntheticInteractor()
+    load_time = time.perf_counter() - start
+    bgi.canvas.draw()
+    ind = int(np.argmax(bgi.z_bolus))  # biggest bolus, so the drag changes the curves the most
+    hover = bolus_event(bgi, 'motion_notify_event', ind)
+
+    results = dict(load=dict(min=load_time, median=load_time, mean=load_time, repeat=1))
+    window = bgi.window.copy() # (compute_insulin_effects() sets the effects on it)
+    results['compute_insulin_effects'] = time_calls(lambda: bgi.compute_insulin_effects(window), args.repeat)
+    results['set_y_BG_insulin_only'] = time_calls(bgi.set_y_BG_insulin_only, args.repeat)
+    results['get_ind_under_point'] = time_calls(lambda: bgi.get_ind_under_point(hover), args.repeat)
+    results['update_annotations'] = time_calls(bgi.update_annotations, args.repeat)
+    drags = [scripted_drag(bgi, ind, args.drag_events) for i in range(max(1, args.repeat//10))]
+    results['drag'] = dict(min=min(drags), median=float(np.median(drags)), mean=float(np.mean(drags)), repeat=len(drags),
+                           events=args.drag_events, per_event_median=float(np.median(drags))/args.drag_events)
+    events = [drag/args.drag_events for drag in drags]
+    results['drag_event'] = dict(min=min(events), median=float(np.median(events)), mean=float(np.mean(events)), repeat=len(drags)) # per mouse-move event
+    bgi.start_following()
+    updates = live_updates(bgi, args.repeat)
+    with deferred_draws(bgi.canvas):
+        results['live_append'] = time_calls(lambda: bgi.append_live_records(next(updates)), args.repeat) # append, recompute and artist updates
+    results['live_draw'] = time_calls(bgi.canvas.draw, args.repeat)
+
+    if args.trace is not None:
+        bgi.trace.save(args.trace)
+    plt.close(bgi.fig)
+    startup_modules = None
+    if args.startup_runs > 0:
+        startup, startup_modules = measure_startup(args)
+        results.update({'startup_' + name: result for name, result in startup.items()})
+    return dict(
+        config=dict(span_hours=args.span_hours, boluses=args.boluses, sgv_interval_minutes=args.sgv_interval, seed=args.seed,
+                    bg_samples=int(np.size(bgi.x_BG)), loaded_boluses=int(np.size(bgi.x_bolus)), use_convolution=bool(bgi.use_convolution),
+                    startup_modules=startup_modules),
+        environment=dict(commit=git_commit(), python=platform.python_version(), numpy=np.__version__,
+                         matplotlib=matplotlib.__version__, machine=platform.machine(), timestamp=datetime.datetime.now().isoformat(timespec='seconds')),
+        results=results, stages=bgi.trace.summary())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the TinkerBolus simulation and interaction hot paths on synthetic data.')
+    parser.add_argument('--span-hours', type=float, default=6, help='window length (hr)')
+    parser.add_argument('--boluses', type=int, default=24, help='number of boluses in the window')
+    parser.add_argument('--sgv-interval', type=float, default=5, help='minutes between SGVs')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic data')
+    parser.add_argument('--repeat', type=int, default=20, help='calls per timing')
+    parser.add_argument('--drag-events', type=int, default=50, help='mouse-move events per scripted drag')
+    parser.add_argument('--startup-runs', type=int, default=3, help='fresh processes to time startup in (0 to skip)')
+    parser.add_argument('--trace', help='also record per-stage timings and save them here as a Chrome trace')
+    parser.add_argument('--output', help='write the JSON results here instead of to stdout')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    for name, result in report['results'].items():
+        print('{:<34}{:>12.3f} ms'.format(name, 1000*result['median']), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+import numpy as np
+import functools
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+# Insulin model and simulation engine for TinkerBolus (no GUI dependencies).
+# Insulin curves are evaluated over whole numpy arrays, and each (tp, td, BG_interval_minutes) combination gets a
+# cached kernel sampled on a fine grid so that computing a curve is a table lookup instead of repeated exp/pow work.
+
+def scalable_exp_iob(t, tp, td):
+    # Scalable Exponential Insulin Model (https://github.com/LoopKit/Loop/issues/388)
+    # Fraction of a bolus remaining on board t minutes after delivery.  t may be a scalar or any array.
+    t = np.asarray(t, dtype=float)
+    tau = tp*(1-tp/td)/(1-2*tp/td)
+    a = 2*tau/td
+    S = 1/(1-a+(1+a)*np.exp(-td/tau))
+    tc = np.clip(t, 0, td)
+    iob = 1-S*(1-a)*((tc**2/(tau*td*(1-a)) - tc/tau - 1)*np.exp(-tc/tau)+1)
+    iob = np.where(t < 0, 1.0, iob)  # equation isn't valid outside of range [0,td]
+    return np.where(t > td, 0.0, iob)
+
+class InsulinKernel:
+    oversample = 50  # table samples per BG interval, and at least one per max_step minutes
+    max_step = 0.1  # keeps linear interpolation error below 1e-6 of a bolus at any BG interval
+
+    def __init__(self, tp, td, interval_minutes):
+        self.tp = tp
+        self.td = td
+        self.interval_minutes = interval_minutes
+
+        # fine table used for lookups at arbitrary bolus times
+        self.step = min(interval_minutes/self.oversample, self.max_step)
+        self.t = np.arange(int(np.ceil(td/self.step)) + 1)*self.step  # last sample is at or beyond td, where IOB is 0
+        self.iob = scalable_exp_iob(self.t, tp, td)
+
+        # coarse table on the BG grid, used as the convolution kernel
+        self.grid_t = np.arange(int(np.ceil(td/interval_minutes)) + 1)*interval_minutes
+        self.grid_iob = scalable_exp_iob(self.grid_t, tp, td)
+
+    def iob_at(self, t, grid=False):
+        # IOB fraction at times t (minutes since bolus): 1 before the bolus and 0 after td
+        # grid=True interpolates the coarse BG-grid table, which matches what binned_effect computes
+        if grid:
+            return np.interp(t, self.grid_t, self.grid_iob, left=1.0, right=0.0)
+        return np.interp(t, self.t, self.iob, left=1.0, right=0.0)
+
+    def effect(self, x, x_bolus, z_bolus, grid=False):
+        # Insulin-only BG change per unit of ISF (i.e. in Units) at times x for boluses z_bolus delivered at x_bolus
+        effect = np.zeros(np.size(x))
+        for xb, zb in zip(x_bolus, z_bolus):
+            effect += zb*(self.iob_at(x - xb, grid) - 1)
+        return effect
+
+    def binned_effect(self, x, x_bolus, z_bolus):
+        # Same as effect(), computed by binning the deliveries onto the BG grid and convolving them with the IOB kernel.
+        # x must be the uniform BG grid (spacing interval_minutes).  Each delivery is split linearly between its two
+        # neighbouring grid points, so the result equals effect(..., grid=True) and is within ~1e-3 U/U of effect() at
+        # BG intervals up to 5 minutes (the error grows with the square of the interval).
+        h = self.interval_minutes
+        x_bolus = np.asarray(x_bolus, dtype=float)
+        z_bolus = np.asarray(z_bolus, dtype=float)
+        n = np.size(x)
+        if n == 0:
+            return np.zeros(0)
+        keep = x_bolus <= x[-1]  # later deliveries have no effect inside the window
+        x_bolus = x_bolus[keep]
+        z_bolus = z_bolus[keep]
+        if np.size(x_bolus) == 0:
+            return np.zeros(n)
+
+        # extend the grid back far enough to hold deliveries made before the first BG sample
+        n_before = max(0, int(np.ceil((x[0] - x_bolus.min())/h)))
+        pos = (x_bolus - x[0])/h + n_before
+        i = np.floor(pos).astype(int)
+        f = pos - i
+        deliveries = np.zeros(n_before + n + 1)
+        np.add.at(deliveries, i, z_bolus*(1-f))
+        np.add.at(deliveries, i+1, z_bolus*f)
+        deliveries = deliveries[:-1]
+
+        return delivery_effect(deliveries, self.grid_iob)[n_before:]
+
+def delivery_effect(deliveries, grid_iob):
+    # Insulin-only BG change per unit of ISF for insulin deliveries binned on the BG grid:
+    # sum_k d[k]*(iob[j-k] - 1) = (d conv iob)[j] - cumsum(d)[j]
+    return convolve(deliveries, grid_iob)[:np.size(deliveries)] - np.cumsum(deliveries)
+
+def rate_delivered(x_breaks, rates):
+    # total insulin (U) delivered by each of x_breaks by a piecewise constant rate (see rate_deliveries)
+    return np.concatenate([[0.0], np.cumsum(rates*np.diff(x_breaks)/60)])
+
+def rate_deliveries(x, x_breaks, rates):
+    # Insulin (U) delivered around each time of the uniform grid x by a piecewise constant rate: rates[i] (U/hr) from
+    # x_breaks[i] to x_breaks[i+1] (minutes).  What is delivered within half an interval of x[k] is assigned to x[k].
+    h = x[1] - x[0] if np.size(x) > 1 else 1.0
+    edges = np.append(x - h/2, x[-1] + h/2)
+    return np.diff(np.interp(edges, x_breaks, rate_delivered(x_breaks, rates)))
+
+def rate_effect(kernel, x, x_breaks, rates, start=0):
+    # Insulin-only BG change per unit of ISF at the BG grid x from a continuous delivery such as temp basals relative
+    # to scheduled basal.  The delivery is binned onto the grid (extended back td before x[0]; anything earlier has been
+    # fully absorbed by x[0] and is subtracted as a total) and convolved with the IOB kernel, so the cost doesn't depend
+    # on how many segments there are.
+    # With start, only x[start:] is computed: deliveries more than td before x[start] have been fully absorbed by
+    # then, so they're just subtracted as a total instead of being convolved.
+    if np.size(x_breaks) < 2 or np.size(x) == 0:
+        return np.zeros(np.size(x) - start)
+    h = kernel.interval_minutes
+    n_before = max(0, int(np.ceil(min(x[0] - x_breaks[0], kernel.td)/h)))
+    first = max(start + n_before - (np.size(kernel.grid_iob) - 1), 0)
+    grid = x[0] + h*np.arange(first - n_before, np.size(x))
+    absorbed = np.interp(grid[0] - h/2, x_breaks, rate_delivered(x_breaks, rates))  # everything delivered before the grid
+    return delivery_effect(rate_deliveries(grid, x_breaks, rates), kernel.grid_iob)[start + n_before - first:] - absorbed
+
+def effect_tail(kernel, x, x_bolus, z_bolus, grid=False):
+    # kernel.effect() at the last samples x of a longer curve, e.g. the samples appended while following live data.
+    # Boluses given more than td before x[0] only add their (negative) amounts there, so the cost depends on the
+    # boluses still on board, not on how long the curve is.
+    if np.size(x) == 0:
+        return np.zeros(0)
+    x_bolus = np.asarray(x_bolus, dtype=float)
+    z_bolus = np.asarray(z_bolus, dtype=float)
+    absorbed = x[0] - x_bolus >= max(kernel.t[-1], kernel.grid_t[-1])
+    return kernel.effect(x, x_bolus[~absorbed], z_bolus[~absorbed], grid) - np.sum(z_bolus[absorbed])
+
+fft_threshold = 2**20  # len(a)*len(b) above which convolve() switches to FFT
+
+def convolve(a, b):
+    # Full linear convolution of a and b, using the FFT for long inputs
+    if np.size(a)*np.size(b) <= fft_threshold:
+        return np.convolve(a, b)
+    n = np.size(a) + np.size(b) - 1
+    nfft = 1 << (n-1).bit_length()
+    return np.fft.irfft(np.fft.rfft(a, nfft)*np.fft.rfft(b, nfft), nfft)[:n]
+
+@functools.lru_cache(maxsize=16)
+def get_insulin_kernel(tp, td, interval_minutes):
+    # Kernels are cached per (tp, td, BG_interval_minutes) combination
+    return InsulinKernel(float(tp), float(td), float(interval_minutes))
+
+def bolus_effects(kernel, x, x_bolus, z_bolus, use_convolution):
+    # Per-bolus insulin-only contributions at times x and their total (per unit ISF).
+    # With use_convolution the total is convolved and the per-bolus entries are left as None to be computed on demand.
+    if use_convolution:
+        return [None]*np.size(x_bolus), kernel.binned_effect(x, x_bolus, z_bolus)
+    effects = [kernel.effect(x, [xb], [zb]) for xb, zb in zip(x_bolus, z_bolus)]
+    return effects, (np.sum(effects, axis=0) if len(effects) > 0 else np.zeros(np.size(x)))
+
+convolution_threshold = 100000 # boluses x samples above which insulin_effect() convolves instead of summing
+
+def insulin_effect(kernel, x, x_bolus, z_bolus):
+    # Insulin-only BG change per unit ISF at times x, choosing direct summation or convolution by problem size
+    if np.size(x_bolus)*np.size(x) > convolution_threshold:
+        return kernel.binned_effect(x, x_bolus, z_bolus)
+    return kernel.effect(x, x_bolus, z_bolus)
+
+def insulin_effect_rate(x, y_BG_insulin_only, interval_minutes):
+    # IE: BG change per BG interval caused by insulin ("central" difference)
+    return -interval_minutes * np.gradient(y_BG_insulin_only)/np.gradient(x)
+
+def moving_average(y, size):
+    # Mean of each size samples centred on each sample of y (last axis), with y mirrored at its ends, the same as
+    # scipy.ndimage.uniform_filter1d(y, size) without importing scipy for it
+    left = size//2
+    padded = np.pad(y, [(0, 0)]*(np.ndim(y) - 1) + [(left, size - 1 - left)], mode='symmetric')
+    return np.lib.stride_tricks.sliding_window_view(padded, size, axis=-1).mean(axis=-1)
+
+def counteraction_effect(x, y_BG_no_insulin, interval_minutes, filter_samples):
+    # ICE: BG change per BG interval not explained by insulin ("central" difference, smoothed)
+    return moving_average((interval_minutes * np.gradient(y_BG_no_insulin)/np.gradient(x)),filter_samples)
+
+def curve_tail(curve, x, y, start, margin, *args):
+    # curve(x, y, *args)[start:] for a curve (such as IE or ICE) whose value at each sample only depends on y within
+    # margin samples of it, computed from the end of x and y alone
+    first = max(start - margin, 0)
+    return curve(x[first:], y[first:], *args)[start - first:]
+
+def isf_sweep(x, y_BG, insulin_units, isf_values, interval_minutes, filter_samples, edited_insulin_units=None):
+    # ICE smoothness and in-range metrics for a grid of ISF values, all computed at once (one row per ISF).
+    # IE and ICE are linear in ISF, so ICE(isf) = ICE(BG) - isf*ICE(insulin_units) needs just two filtered curves.
+    # A plausible ISF gives a smooth ICE that rarely goes negative.  The in-range metrics are for the edited insulin
+    # (edited_insulin_units, per unit ISF), showing how much a what-if result depends on the ISF chosen.
+    isf = np.asarray(isf_values, dtype=float)[:, None]
+    ICE = counteraction_effect(x, y_BG, interval_minutes, filter_samples) - isf*counteraction_effect(x, insulin_units, interval_minutes, filter_samples)
+    if edited_insulin_units is None:
+        edited_insulin_units = insulin_units
+    Y = y_BG + isf*(np.asarray(edited_insulin_units) - insulin_units)
+    return dict(isf=isf[:, 0], ice_roughness=np.sqrt(np.mean(np.diff(ICE, axis=1)**2, axis=1)), ice_negative=np.mean(ICE < 0, axis=1),
+                tir=np.mean((Y >= 70) & (Y <= 180), axis=1), tbr=np.mean(Y < 70, axis=1), tar=np.mean(Y > 180, axis=1))
+
+def bg_metrics(y):
+    # Summary metrics for a BG curve (mg/dL); fractions of samples for the time-in-range values
+    y = np.asarray(y, dtype=float)
+    mean = np.mean(y)
+    return dict(samples=np.size(y), mean=mean, sd=np.std(y), min=np.min(y), max=np.max(y),
+                gmi=3.31 + 0.02392*mean,  # glucose management indicator (%)
+                tir=np.mean((y >= 70) & (y <= 180)), tbr=np.mean(y < 70), tar=np.mean(y > 180))
+
+class GrowingArray:
+    # A 1-D float array with spare capacity, so appending to it is amortized O(1).  values is a view of the filled
+    # part (like BolusStore's columns); it's only replaced when extend() has to grow the buffer.
+
+    def __init__(self, values, capacity=16):
+        values = np.asarray(values, dtype=float)
+        self.n = np.size(values)
+        self.buffer = np.zeros(max(capacity, 2*self.n))
+        self.buffer[:self.n] = values
+
+    @property
+    def values(self):
+        return self.buffer[:self.n]
+
+    def extend(self, values, start=None):
+        # writes values from index start (by default, the end) on, dropping anything after them; returns the new values
+        start = self.n if start is None else start
+        n = start + np.size(values)
+        if n > np.size(self.buffer):
+            buffer = np.zeros(max(n, 2*np.size(self.buffer)))
+            buffer[:start] = self.buffer[:start]
+            self.buffer = buffer
+        self.buffer[start:n] = values
+        self.n = n
+        return self.values
+
+class RunningMetrics:
+    # bg_metrics() plus the range_cost() score for a BG curve that is edited a slice at a time (e.g. while a bolus is
+    # dragged, only the samples within td of it change).  Sums and in-range counts are adjusted over the changed samples
+    # only.  Min and max are kept per block of block_size samples, so an update rescans just the touched blocks and then
+    # the short list of block minima/maxima.  Samples can also be appended (e.g. while following live data).
+    block_size = 256
+
+    def __init__(self, y, low=70, high=180, low_weight=4):
+        self.low = low
+        self.high = high
+        self.low_weight = low_weight
+        self.reset(y)
+
+    def reset(self, y):
+        self.values = GrowingArray(y)
+        self.y = self.values.values
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.below = 0
+        self.above = 0
+        self.outside = 0.0
+        self.add(self.y, 1)
+        self.block_min = GrowingArray(np.zeros(0))
+        self.block_max = GrowingArray(np.zeros(0))
+        self.update_blocks(0, np.size(self.y))
+
+    def add(self, y, sign):
+        self.sum += sign*np.sum(y)
+        self.sum_squares += sign*np.dot(y, y)
+        self.below += sign*np.count_nonzero(y < self.low)
+        self.above += sign*np.count_nonzero(y > self.high)
+        self.outside += sign*np.sum(np.maximum(self.low - y, 0)*self.low_weight + np.maximum(y - self.high, 0))
+
+    def update_blocks(self, lo, hi):
+        # rescan the blocks holding samples lo:hi
+        first, last = lo//self.block_size, (hi - 1)//self.block_size + 1
+        blocks = self.y[first*self.block_size:last*self.block_size]
+        starts = np.arange(0, np.size(blocks), self.block_size)
+        if np.size(starts) == 0:
+            return
+        for block_values, reduce in ((self.block_min, np.minimum.reduceat), (self.block_max, np.maximum.reduceat)):
+            if last <= block_values.n:
+                block_values.values[first:last] = reduce(blocks, starts)
+            else:
+                block_values.extend(reduce(blocks, starts), first)
+
+    def update(self, y, lo=0, hi=None):
+        # y is the whole new curve, of which only samples lo:hi have changed
+        n = np.size(self.y)
+        lo = max(lo, 0)
+        hi = n if hi is None else min(hi, n)
+        if lo >= hi:
+            return
+        new = np.asarray(y[lo:hi], dtype=float)
+        self.add(self.y[lo:hi], -1)
+        self.add(new, 1)
+        self.y[lo:hi] = new
+        self.update_blocks(lo, hi)
+
+    def append(self, y):
+        # new samples y added to the end of the curve
+        n = np.size(self.y)
+        self.y = self.values.extend(y)
+        self.add(self.y[n:], 1)
+        self.update_blocks(n, np.size(self.y))
+
+    def metrics(self):
+        # same keys as bg_metrics(), plus score (range_cost(), lower is better)
+        n = np.size(self.y)
+        mean = self.sum/n
+        tbr, tar = self.below/n, self.above/n
+        return dict(samples=n, mean=mean, sd=np.sqrt(max(self.sum_squares/n - mean**2, 0)), min=np.min(self.block_min.values), max=np.max(self.block_max.values),
+                    gmi=3.31 + 0.02392*mean, tir=1 - tbr - tar, tbr=tbr, tar=tar,
+                    score=self.low_weight*tbr + tar + 1e-4*self.outside/n)
+
+class Scenario:
+    # A what-if rule set applied to a window's boluses.  Rules are comma separated:
+    #   shift:<selector>:<minutes>    move the selected boluses (negative is earlier)
+    #   scale:<selector>:<factor>     scale the selected bolus amounts
+    #   isf:<mg/dL/U>                 use this ISF instead of the default
+    # Selectors are all, meal (within meal_window_minutes of a carb entry) and correction (everything else).
+    meal_window_minutes = 30
+
+    def __init__(self, name, rules=''):
+        self.name = name
+        self.rules = [rule.split(':') for rule in rules.split(',') if rule.strip() != '']
+        for rule in self.rules:
+            if not ((rule[0] in ('shift', 'scale') and len(rule) == 3 and rule[1] in ('all', 'meal', 'correction')) or (rule[0] == 'isf' and len(rule) == 2)):
+                raise ValueError('Unrecognized scenario rule: ' + ':'.join(rule))
+            float(rule[-1])
+
+    @classmethod
+    def parse(cls, spec):
+        # 'name=rules', e.g. 'early=shift:meal:-15'
+        name, _, rules = spec.partition('=')
+        return cls(name, rules)
+
+    def get_isf(self, isf):
+        for rule in self.rules:
+            if rule[0] == 'isf':
+                isf = float(rule[1])
+        return isf
+
+    def select(self, selector, x_bolus, x_carb):
+        if selector == 'all':
+            return np.ones(np.size(x_bolus), dtype=bool)
+        meal = np.zeros(np.size(x_bolus), dtype=bool)
+        if np.size(x_carb) > 0:
+            meal = np.min(np.abs(np.subtract.outer(x_bolus, x_carb)), axis=1) <= self.meal_window_minutes
+        return meal if selector == 'meal' else ~meal
+
+    def apply(self, x_bolus, z_bolus, x_carb):
+        # returns the scenario's bolus times and amounts.  Boluses are selected by their original times, so a shift
+        # doesn't change which boluses later rules apply to and the order of the rules doesn't matter.
+        selected = {selector: self.select(selector, x_bolus, x_carb) for selector in ('all', 'meal', 'correction')}
+        x_bolus = np.array(x_bolus, dtype=float)
+        z_bolus = np.array(z_bolus, dtype=float)
+        for rule in self.rules:
+            if rule[0] == 'shift':
+                x_bolus[selected[rule[1]]] += float(rule[2])
+            elif rule[0] == 'scale':
+                z_bolus[selected[rule[1]]] *= float(rule[2])
+        return x_bolus, z_bolus
+
+def what_if(kernel, x_BG, y_BG, x_bolus, z_bolus, x_carb, isf, scenario):
+    # Counterfactual BG for a scenario: the insulin-independent BG (derived with the scenario's ISF) plus the
+    # insulin effect of the scenario's boluses
+    isf = scenario.get_isf(isf)
+    y_BG_no_insulin = y_BG - isf*insulin_effect(kernel, x_BG, x_bolus, z_bolus)
+    x_scenario, z_scenario = scenario.apply(x_bolus, z_bolus, x_carb)
+    return y_BG_no_insulin + isf*insulin_effect(kernel, x_BG, x_scenario, z_scenario)
+
+def agp_percentiles(Y, percentiles=(5, 25, 50, 75, 95)):
+    # AGP-style percentile curves of stacked days: Y is (..., days, samples of the day), with nan where a day has no
+    # data.  All curves are done in one nanpercentile pass; the result is (..., percentiles, samples).
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # times of day without any data are left as nan
+        return np.moveaxis(np.nanpercentile(Y, percentiles, axis=-2), 0, -2)
+
+def range_cost(Y, low=70, high=180, low_weight=4):
+    # Cost of BG curves (one per row of Y): weighted fraction of time below low plus fraction of time above high.
+    # A small term for the mean distance outside the range breaks ties between curves with the same time in range.
+    Y = np.atleast_2d(Y)
+    outside = np.maximum(low - Y, 0)*low_weight + np.maximum(Y - high, 0)
+    return low_weight*np.mean(Y < low, axis=1) + np.mean(Y > high, axis=1) + 1e-4*np.mean(outside, axis=1)
+
+class BolusOptimizer:
+    # Searches bolus shifts (and optionally amounts) that minimize range_cost() for a window.
+    # Shifts are restricted to multiples of shift_step_minutes, so the effect of 1 U of every bolus at every allowed
+    # shift is tabulated once; a batch of candidate schedules is then one (candidates x table rows) matrix product.
+    # The search is a randomized local search: each round perturbs the best schedule so far into
+    # candidates_per_round variants and keeps the best, with the perturbation radius shrinking over the rounds.
+    max_shift_minutes = 60
+    shift_step_minutes = 5
+    scale_range = (0.5, 1.5)  # amount factors allowed with optimize_amounts
+    max_boluses = 40  # only the largest boluses are optimized; the rest stay where they are
+    candidates_per_round = 2000
+    rounds = 20
+    change_penalty = 1e-3  # prefers schedules that change less when costs are otherwise equal
+    chunk_entries = 2**22  # candidate weight-matrix entries evaluated at once
+
+    def __init__(self, kernel, x, y_BG_no_insulin, x_bolus, z_bolus, isf, optimize_amounts=False, workers=1, seed=None):
+        self.x_bolus = np.asarray(x_bolus, dtype=float)
+        self.z_bolus = np.asarray(z_bolus, dtype=float)
+        self.isf = isf
+        self.optimize_amounts = optimize_amounts
+        self.workers = workers
+        self.rng = np.random.default_rng(seed)
+
+        order = np.argsort(-np.abs(self.z_bolus), kind='stable')
+        self.free = np.sort(order[:self.max_boluses])
+        fixed = np.sort(order[self.max_boluses:])
+        self.y_fixed = np.asarray(y_BG_no_insulin, dtype=float) + isf*kernel.effect(x, self.x_bolus[fixed], self.z_bolus[fixed])
+
+        n_steps = int(self.max_shift_minutes//self.shift_step_minutes)
+        self.shifts = np.arange(-n_steps, n_steps + 1)*self.shift_step_minutes
+        self.no_shift = n_steps  # index of a zero shift
+        times = (self.x_bolus[self.free, None] + self.shifts[None, :]).ravel()
+        self.table = kernel.iob_at(np.subtract.outer(x, times).T) - 1  # (boluses*shifts, samples), per unit insulin
+        self.evaluated = 0
+
+    def curves(self, k, scale):
+        # BG curves for candidate schedules: k holds shift indices and scale amount factors, both (candidates, boluses)
+        n_free = np.size(self.free)
+        weights = np.zeros((np.shape(k)[0], n_free*np.size(self.shifts)))
+        weights[np.arange(np.shape(k)[0])[:, None], np.arange(n_free)*np.size(self.shifts) + k] = self.z_bolus[self.free]*scale
+        return self.y_fixed + self.isf*(weights @ self.table)
+
+    def cost(self, k, scale):
+        change = np.mean(np.abs(self.shifts[k]), axis=1)/self.max_shift_minutes + np.mean(np.abs(np.log(scale)), axis=1)
+        return range_cost(self.curves(k, scale)) + self.change_penalty*change
+
+    def evaluate(self, k, scale):
+        # costs for a batch of candidates, split into chunks (evaluated on a thread pool when workers > 1)
+        chunk = max(1, self.chunk_entries//max(1, self.table.shape[0]))
+        starts = range(0, np.shape(k)[0], chunk)
+        if self.workers > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                costs = list(executor.map(lambda i: self.cost(k[i:i+chunk], scale[i:i+chunk]), starts))
+        else:
+            costs = [self.cost(k[i:i+chunk], scale[i:i+chunk]) for i in starts]
+        self.evaluated += np.shape(k)[0]
+        return np.concatenate(costs)
+
+    def optimize(self, rounds=None):
+        # returns the best schedule found as (x_bolus, z_bolus, cost), with the original cost in self.original_cost
+        rounds = self.rounds if rounds is None else rounds
+        n_free = np.size(self.free)
+        best_k = np.full(n_free, self.no_shift)
+        best_scale = np.ones(n_free)
+        best_cost = self.original_cost = self.evaluate(best_k[None, :], best_scale[None, :])[0]
+        if n_free == 0:
+            return self.x_bolus.copy(), self.z_bolus.copy(), best_cost
+
+        m = self.candidates_per_round
+        for r in range(rounds):
+            radius = max(1, int(round(self.no_shift*(1 - r/rounds))))
+            # perturb a random subset of the boluses in each candidate (at least one, on average two)
+            perturb = self.rng.random((m, n_free)) < min(1, 2/n_free)
+            perturb[np.arange(m), self.rng.integers(n_free, size=m)] = True
+            k = np.clip(best_k + perturb*self.rng.integers(-radius, radius + 1, size=(m, n_free)), 0, np.size(self.shifts) - 1)
+            scale = np.tile(best_scale, (m, 1))
+            if self.optimize_amounts:
+                scale = np.clip(scale*np.exp(perturb*self.rng.normal(0, 0.3*(1 - r/rounds) + 0.02, size=(m, n_free))), *self.scale_range)
+            costs = self.evaluate(k, scale)
+            i = np.argmin(costs)
+            if costs[i] < best_cost:
+                best_k, best_scale, best_cost = k[i], scale[i], costs[i]
+
+        x_bolus = self.x_bolus.copy()
+        z_bolus = self.z_bolus.copy()
+        x_bolus[self.free] += self.shifts[best_k]
+        z_bolus[self.free] *= best_scale
+        return x_bolus, z_bolus, best_cost
@@ -0,0 +1,66 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Opt-in timing instrumentation for TinkerBolus (no GUI dependencies).
+# Spans can be recorded from any thread and are saved in Chrome trace format, which can be opened in
+# chrome://tracing or https://ui.perfetto.dev.  A disabled Tracer records nothing.
+
+class Tracer:
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, category='interaction'):
+        # times the body of a with block
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, time.perf_counter())
+
+    def add_span(self, name, category, start, stop):
+        # start and stop are time.perf_counter() values
+        if not self.enabled:
+            return
+        event = dict(name=name, cat=category, ph='X', ts=1e6*(start - self.t0), dur=1e6*(stop - start),
+                     pid=os.getpid(), tid=threading.get_ident())
+        with self.lock:
+            self.events.append(event)
+
+    def add_counter(self, name, value):
+        if not self.enabled:
+            return
+        event = dict(name=name, ph='C', ts=1e6*(time.perf_counter() - self.t0), pid=os.getpid(), args={name: value})
+        with self.lock:
+            self.events.append(event)
+
+    def summary(self):
+        # {span name: dict(count, total_ms, mean_ms, max_ms)}
+        with self.lock:
+            spans = [event for event in self.events if event['ph'] == 'X']
+        summary = {}
+        for event in spans:
+            durations = summary.setdefault(event['name'], [])
+            durations.append(event['dur']/1000)
+        return {name: dict(count=len(d), total_ms=sum(d), mean_ms=sum(d)/len(d), max_ms=max(d)) for name, d in summary.items()}
+
+    def save(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+
+    def print_summary(self):
+        print('{:<24}{:>8}{:>12}{:>12}{:>12}'.format('stage', 'count', 'total ms', 'mean ms', 'max ms'))
+        for name, s in sorted(self.summary().items(), key=lambda item: -item[1]['total_ms']):
+            print('{:<24}{:>8}{:>12.1f}{:>12.2f}{:>12.2f}'.format(name, s['count'], s['total_ms'], s['mean_ms'], s['max_ms']))
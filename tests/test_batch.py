@@ -0,0 +1,37 @@
+import datetime
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TinkerBolusBatch import day_what_ifs, split_days
+from TinkerBolusData import WindowData, synthetic_records
+from TinkerBolusEngine import Scenario, get_insulin_kernel, insulin_effect
+
+# Days simulated one at a time, checked against one continuous run over all of them
+
+def test_days_carry_insulin_over_midnight():
+    td, isf = 360, 150
+    dayStarts = [datetime.datetime(2024, 3, 1, 6) + datetime.timedelta(days=i) for i in range(2)]
+    start = dayStarts[0] - datetime.timedelta(minutes=td)
+    records = synthetic_records(start, dayStarts[-1] + datetime.timedelta(days=1), 5, 80, seed=5)
+    day_records, prior_records = split_days(records, dayStarts, td)
+    kernel = get_insulin_kernel(75, td, 5)
+    scenarios = [Scenario.parse('early=shift:meal:-30,scale:correction:0.8'), Scenario.parse('late=shift:all:45')]
+
+    data = WindowData(day_records[1], 0.0, 5, prior_records[1])
+    ys = day_what_ifs(data, prior_records[1], kernel, isf, scenarios)
+
+    # the same boluses and carbs, on one time axis from start
+    minutes = lambda times: (times - np.datetime64(start, 'ms'))/np.timedelta64(60, 's')
+    bolus_times, z_bolus = records.bolus_entries()
+    carb_times, _ = records.carb_entries()
+    x_bolus, x_carb = minutes(bolus_times), minutes(carb_times)
+    lookback = x_bolus > minutes(np.datetime64(dayStarts[1] - datetime.timedelta(minutes=td), 'ms'))
+    x_bolus, z_bolus = x_bolus[lookback], z_bolus[lookback]
+    x = data.x_BG + minutes(data.t0)
+    for scenario, y in zip(scenarios, ys):
+        x_scenario, z_scenario = scenario.apply(x_bolus, z_bolus, x_carb)
+        expected = isf*(insulin_effect(kernel, x, x_scenario, z_scenario) - insulin_effect(kernel, x, x_bolus, z_bolus))
+        np.testing.assert_allclose(y - data.y_BG, expected, rtol=0, atol=1e-9)
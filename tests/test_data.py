@@ -0,0 +1,146 @@
+import datetime
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TinkerBolusData import BolusStore, EditJournal, WindowData, parse_iso_times, synthetic_basal_schedule, synthetic_records
+from TinkerBolusEngine import get_insulin_kernel, insulin_effect
+
+# WindowData.append(), as used while following live data, checked against loading the whole span at once
+
+def test_append_with_overlap_and_late_uploads_matches_a_fresh_load():
+    start = datetime.datetime(2023, 9, 1, 13)
+    stop = start + datetime.timedelta(hours=9)
+    records = synthetic_records(start, stop, 5, 60, seed=3)
+    schedule = synthetic_basal_schedule()
+    # every 7th SGV turns up 40 minutes late and every 3rd treatment 30 minutes late
+    sgv_delay = np.where(np.arange(np.size(records.sgv_times)) % 7 == 0, np.timedelta64(40, 'm'), np.timedelta64(0, 'm'))
+    treatment_delay = np.where(np.arange(np.size(records.treatment_times)) % 3 == 0, np.timedelta64(30, 'm'), np.timedelta64(0, 'm'))
+    def uploaded_by(now):
+        now = np.datetime64(now, 'ms')
+        return records.take(records.sgv_times + sgv_delay <= now, records.treatment_times + treatment_delay <= now)
+
+    now = start + datetime.timedelta(hours=6)
+    window = WindowData(uploaded_by(now).select(start, now), 0.0, 5, basal_schedule=schedule)
+    while now < stop + datetime.timedelta(hours=1):
+        now += datetime.timedelta(minutes=5)
+        # each poll looks an hour back again
+        window.append(uploaded_by(now).select(now - datetime.timedelta(hours=1, minutes=5), stop), 0.0, 5)
+
+    fresh = WindowData(records.select(start, stop), 0.0, 5, basal_schedule=schedule)
+    for column in ('x_BG_orig', 'x_BG', 'y_BG', 'x_basal_breaks', 'basal_rates'):
+        np.testing.assert_array_equal(getattr(window, column), getattr(fresh, column))
+    for x, z in (('x_bolus', 'z_bolus'), ('x_carb', 'z_carb')):
+        order, fresh_order = np.argsort(getattr(window, x)), np.argsort(getattr(fresh, x))
+        np.testing.assert_array_equal(getattr(window, x)[order], getattr(fresh, x)[fresh_order])
+        np.testing.assert_array_equal(getattr(window, z)[order], getattr(fresh, z)[fresh_order])
+
+def test_append_of_records_already_loaded_changes_nothing():
+    start = datetime.datetime(2023, 9, 1, 13)
+    records = synthetic_records(start, start + datetime.timedelta(hours=6), 5, 24, seed=1)
+    window = WindowData(records, 0.0, 5, basal_schedule=synthetic_basal_schedule())
+    assert window.append(records.select(start + datetime.timedelta(hours=5), start + datetime.timedelta(hours=6)), 0.0, 5) is None
+
+# Boluses from the td lookback before a window, kept apart as fixed insulin, checked against a window loaded over the
+# lookback as well
+
+def test_prior_boluses_carry_their_insulin_into_the_window():
+    td = 360
+    start = datetime.datetime(2023, 9, 2, 8)
+    lookback = start - datetime.timedelta(minutes=td)
+    stop = start + datetime.timedelta(hours=6)
+    records = synthetic_records(lookback - datetime.timedelta(hours=2), stop, 5, 40, seed=2)
+    window = WindowData(records.select(start, stop), 0.2, 5, records.select(lookback, start + datetime.timedelta(milliseconds=1)))
+    assert np.size(window.x_prior_bolus) > 0
+    assert np.all((window.x_prior_bolus <= 0) & (window.x_prior_bolus > -td - 5))
+    assert np.all(window.z_prior_bolus > 0.2)
+
+    long_window = WindowData(records.select(lookback, stop), 0.2, 5)
+    x = window.x_BG
+    x_long = x + (window.t0 - long_window.t0)/np.timedelta64(60, 's')
+    kernel = get_insulin_kernel(75, td, 5)
+    effect = insulin_effect(kernel, x, window.x_bolus, window.z_bolus) + insulin_effect(kernel, x, window.x_prior_bolus, window.z_prior_bolus)
+    np.testing.assert_allclose(effect, insulin_effect(kernel, x_long, long_window.x_bolus, long_window.z_bolus), rtol=0, atol=1e-9)
+
+# ISO 8601 time strings, as Nightscout stores them
+
+def test_parse_iso_times_offsets():
+    times = parse_iso_times(['2024-01-15T10:00:00Z', '2024-01-15T10:00:00', '2024-01-15T10:00:00+01:00', '2024-01-15T10:00:00+0100',
+                             '2024-01-15T10:00:00+01', '2024-01-15T10:00:00.250-05', '2024-01-15T10:00:00-05:30'])
+    expected = np.array(['2024-01-15T10:00', '2024-01-15T10:00', '2024-01-15T09:00', '2024-01-15T09:00', '2024-01-15T09:00',
+                         '2024-01-15T15:00:00.250', '2024-01-15T15:30'], dtype='datetime64[ms]')
+    np.testing.assert_array_equal(times, expected)
+    with pytest.raises(ValueError):
+        parse_iso_times(['2024-01-15T10:00:00+1'])
+
+# BolusStore edits replayed and reversed through an EditJournal, the way BGInteractor.apply_edit() does, checked
+# against the store's contents after each edit.  Effect curves are stand-ins that identify their bolus.
+
+def apply_edit(store, entry, undo=False):
+    if entry['op'] == 'move':
+        x = entry['x0'] if undo else entry['x1']
+        store.x[entry['index']] = x
+        store.x_effect[entry['index']] = x
+        store.effects[entry['index']] = entry['effect0' if undo else 'effect1']
+    elif entry['op'] == 'insert':
+        if undo:
+            store.remove(store.n - 1)
+        else:
+            store.append(entry['x'], 0, entry['z'], np.array([entry['x'], entry['z']]))
+    elif entry['op'] == 'delete':
+        if undo:
+            store.restore(entry['index'], entry['x'], entry['z'], entry['x_effect'], entry['effect'])
+        else:
+            store.remove(entry['index'])
+
+def store_contents(store):
+    return (store.x[:store.n].tolist(), store.z[:store.n].tolist(), store.x_effect[:store.n].tolist(),
+            [None if e is None else e.tolist() for e in store.effects])
+
+def test_edits_undo_and_redo_through_the_journal():
+    rng = np.random.default_rng(6)
+    store = BolusStore([10.0, 20.0, 30.0], [1.0, 2.0, 3.0])
+    journal = EditJournal()
+    journal.record(dict(op='append', start=0, stop=3))
+    states = [store_contents(store)]
+    for step in range(80):
+        edit = rng.choice(3, p=[0.5, 0.25, 0.25]) # mostly inserts, so the store has to grow
+        i = int(rng.integers(store.n)) if store.n > 0 else None
+        if edit == 0 or i is None:
+            entry = dict(op='insert', x=float(rng.uniform(0, 600)), z=float(rng.uniform(0.1, 3)))
+        elif edit == 1:
+            x1 = float(rng.uniform(0, 600))
+            entry = dict(op='move', index=i, x0=store.x[i], x1=x1, effect0=store.effects[i], effect1=np.array([x1, store.z[i]]))
+        else:
+            entry = dict(op='delete', index=i, x=store.x[i], z=store.z[i], x_effect=store.x_effect[i], effect=store.effects[i])
+        apply_edit(store, entry)
+        journal.record(entry)
+        states.append(store_contents(store))
+    assert store.capacity > 16
+
+    for state in reversed(states[:-1]):
+        apply_edit(store, journal.undo(), undo=True)
+        assert store_contents(store) == state
+    assert journal.undo() is None # the 'append' entry isn't undone
+    for state in states[1:]:
+        apply_edit(store, journal.redo())
+        assert store_contents(store) == state
+    assert journal.redo() is None
+
+    # a new edit after an undo drops the undone one
+    apply_edit(store, journal.undo(), undo=True)
+    journal.record(dict(op='insert', x=5.0, z=1.0))
+    assert journal.redo() is None
+    assert len(journal.entries) == len(states) and journal.entries[-1]['x'] == 5.0
+
+def test_journal_saves_without_effects():
+    journal = EditJournal()
+    journal.record(dict(op='insert', x=5.0, z=1.0, effect=np.ones(3)))
+    journal.record(dict(op='move', index=0, x0=np.float64(5.0), x1=9.0, effect0=np.ones(3), effect1=np.ones(3)))
+    journal.undo()
+    saved = EditJournal.from_json(journal.to_json())
+    assert saved.entries == [dict(op='insert', x=5.0, z=1.0), dict(op='move', index=0, x0=5.0, x1=9.0)]
+    assert saved.position == 1
@@ -0,0 +1,174 @@
+import math
+import os
+import sys
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+from matplotlib.backend_bases import MouseEvent
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TinkerBolusBenchmark import SyntheticInteractor
+from TinkerBolusEngine import InsulinKernel, RunningMetrics, Scenario, bg_metrics, bolus_effects, range_cost, rate_effect, scalable_exp_iob
+
+# The vectorized insulin model and its kernel tables, checked against the original scalar formula
+# (BGInteractor.scalable_exp_iob before the engine was split out), copied here as the reference.
+
+def scalar_iob(t, tp, td):
+    if t < 0:     # equation isn't valid outside of range [0,td]
+        return 1
+    if t > td:
+        return 0
+    tau = tp*(1-tp/td)/(1-2*tp/td)
+    a = 2*tau/td
+    S = 1/(1-a+(1+a)*math.exp(-td/tau))
+    return 1-S*(1-a)*((pow(t,2)/(tau*td*(1-a)) - t/tau - 1)*math.exp(-t/tau)+1)
+
+def scalar_effect(x, x_bolus, z_bolus, tp, td):
+    # insulin-only BG change per unit ISF, as set_y_BG_insulin_only() computed it
+    return np.array([sum(zb*(scalar_iob(t - xb, tp, td) - 1) for xb, zb in zip(x_bolus, z_bolus)) for t in x])
+
+models = [(tp, td) for tp in (55, 65, 75, 90) for td in (300, 360, 420, 480)]
+intervals = [1, 5, 15]
+
+@pytest.mark.parametrize('tp, td', models)
+def test_vectorized_iob_matches_scalar(tp, td):
+    t = np.concatenate([np.linspace(-60, td + 60, 997), [0, tp, td]])
+    expected = np.array([scalar_iob(ti, tp, td) for ti in t])
+    np.testing.assert_allclose(scalable_exp_iob(t, tp, td), expected, rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize('tp, td', models)
+@pytest.mark.parametrize('interval', intervals)
+def test_kernel_table_matches_scalar(tp, td, interval):
+    # linear interpolation of the fine table is within 1e-6 of a bolus at any BG interval
+    kernel = InsulinKernel(tp, td, interval)
+    t = np.random.default_rng(0).uniform(-30, td + 30, 2000)
+    expected = np.array([scalar_iob(ti, tp, td) for ti in t])
+    np.testing.assert_allclose(kernel.iob_at(t), expected, rtol=0, atol=1e-6)
+
+@pytest.mark.parametrize('tp, td', models[::3])
+@pytest.mark.parametrize('interval', intervals)
+def test_effects_match_scalar(tp, td, interval):
+    # Direct summation is within the table tolerance per unit of insulin; the binned convolution (boluses split
+    # between BG samples) is within 1e-3 per unit up to 5-minute intervals, growing with the square of the interval
+    rng = np.random.default_rng(1)
+    x = np.arange(0, 720, interval, dtype=float)
+    x_bolus = np.sort(rng.uniform(-td, 700, 12))
+    z_bolus = np.round(rng.uniform(0.05, 5, 12), 2)
+    expected = scalar_effect(x, x_bolus, z_bolus, tp, td)
+    kernel = InsulinKernel(tp, td, interval)
+    units = np.sum(z_bolus)
+    np.testing.assert_allclose(bolus_effects(kernel, x, x_bolus, z_bolus, False)[1], expected, rtol=0, atol=1e-6*units)
+    np.testing.assert_allclose(bolus_effects(kernel, x, x_bolus, z_bolus, True)[1], expected, rtol=0, atol=1e-3*units*max(1, interval/5)**2)
+
+@pytest.mark.parametrize('tp, td', models[::5])
+@pytest.mark.parametrize('interval', intervals)
+def test_rate_effect_matches_scalar(tp, td, interval):
+    # Temp basals (net rates in U/hr, some below scheduled basal) from more than td before the window to inside it, as
+    # a delivery every 15 seconds; binning them onto the BG grid is within the binned bolus tolerance per unit delivered
+    rng = np.random.default_rng(3)
+    x = np.arange(0, 720, interval, dtype=float)
+    x_breaks = np.concatenate([[-td - 100], np.sort(rng.uniform(-td - 100, 650, 15)), [650]])
+    rates = np.round(rng.uniform(-1, 2, 16), 2)
+    t = np.arange(x_breaks[0], x_breaks[-1], 0.25) + 0.125
+    deliveries = rates[np.searchsorted(x_breaks, t) - 1]*0.25/60
+    expected = np.sum(deliveries*(scalable_exp_iob(x[:, None] - t, tp, td) - 1), axis=1)
+    units = np.sum(np.abs(deliveries))
+    kernel = InsulinKernel(tp, td, interval)
+    np.testing.assert_allclose(rate_effect(kernel, x, x_breaks, rates), expected, rtol=0, atol=1e-3*units*max(1, interval/5)**2)
+    # only the tail, as when following live data
+    for start in (1, np.size(x)//2, np.size(x) - 1):
+        np.testing.assert_allclose(rate_effect(kernel, x, x_breaks, rates, start), rate_effect(kernel, x, x_breaks, rates)[start:], rtol=0, atol=1e-9)
+
+def test_scenario_rules_select_by_original_times():
+    # a shift that moves a bolus out of (or into) a meal's window doesn't change what later rules select
+    x_bolus, z_bolus, x_carb = [0, 40, 100], [1, 1, 1], [25]
+    results = [Scenario('s', rules).apply(x_bolus, z_bolus, x_carb) for rules in
+               ('shift:meal:-20,scale:meal:2,scale:correction:0.5', 'scale:correction:0.5,scale:meal:2,shift:meal:-20')]
+    for x, z in results:
+        np.testing.assert_array_equal(x, [-20, 20, 100])
+        np.testing.assert_array_equal(z, [2, 2, 0.5])
+
+# BGInteractor's per-bolus effect cache, kept up to date one bolus at a time as boluses are added, moved and removed,
+# checked against summing every bolus again.  With convolution the window's total is convolved, and the per-bolus
+# curves use the BG-grid table so they stay consistent with it.
+
+@pytest.mark.parametrize('use_convolution', [False, True])
+def test_incremental_bolus_effects_match_a_full_recompute(monkeypatch, use_convolution):
+    monkeypatch.setattr(SyntheticInteractor, 'convolution_threshold', -1 if use_convolution else np.inf)
+    bgi = SyntheticInteractor()
+    assert bgi.use_convolution == use_convolution
+    rng = np.random.default_rng(2)
+    for step in range(40):
+        edit = rng.integers(3)
+        i = rng.integers(max(bgi.boluses.n, 1))
+        if edit == 0 or bgi.boluses.n < 2:
+            bgi.add_bolus(rng.uniform(-bgi.td, bgi.x_BG[-1]), np.round(rng.uniform(0.1, 3), 2))
+        elif edit == 1:
+            bgi.move_bolus(i, bgi.x_bolus[i] + rng.uniform(-90, 90))
+        else:
+            bgi.remove_bolus(i)
+        expected = bgi.insulin_kernel().effect(bgi.x_BG, bgi.x_bolus, bgi.z_bolus, grid=bgi.use_convolution) + bgi.fixed_insulin_units
+        np.testing.assert_allclose(bgi.insulin_units, expected, rtol=0, atol=1e-9)
+    for i in range(bgi.boluses.n):
+        np.testing.assert_allclose(bgi.get_bolus_effect(i), bgi.bolus_effect(bgi.x_bolus[i], bgi.z_bolus[i]), rtol=0, atol=1e-12)
+    # and the way the GUI re-sums them (binned_effect(), with convolution)
+    insulin_units = bgi.insulin_units.copy()
+    bgi.sum_bolus_effects()
+    np.testing.assert_allclose(bgi.insulin_units, insulin_units, rtol=0, atol=1e-9)
+    plt.close(bgi.fig)
+
+# Hit-testing with the x-sorted index of bolus display coordinates, checked against the nearest bolus found by
+# measuring the distance to every one
+
+def nearest_bolus(bgi, event):
+    xy = bgi.ax.transData.transform(np.column_stack([bgi.x_bolus, bgi.y_bolus]))
+    d = np.hypot(xy[:,0] - event.x, xy[:,1] - event.y)
+    return None if d.min() >= bgi.epsilon else np.flatnonzero(d == d.min())[0]
+
+def test_hit_index_matches_nearest_bolus():
+    bgi = SyntheticInteractor()
+    rng = np.random.default_rng(4)
+    # a bolus on top of another one: the lower index wins
+    bgi.add_bolus(bgi.x_bolus[0], 1.0)
+    bgi.y_bolus[-1] = bgi.y_bolus[0]
+    bgi.invalidate_hit_index()
+    for view in range(2):
+        xy = bgi.ax.transData.transform(np.column_stack([bgi.x_bolus, bgi.y_bolus]))
+        near = xy[rng.integers(bgi.boluses.n, size=400)] + rng.normal(0, bgi.epsilon, (400, 2))
+        anywhere = rng.uniform(bgi.ax.bbox.min, bgi.ax.bbox.max, (400, 2))
+        for x, y in np.concatenate([near, anywhere, xy]):
+            event = MouseEvent('button_press_event', bgi.canvas, x, y)
+            assert bgi.get_ind_under_point(event) == nearest_bolus(bgi, event)
+        # zooming in rebuilds the index
+        x_min, x_max = bgi.ax.get_xlim()
+        bgi.ax.set_xlim(x_min + (x_max - x_min)/4, x_max - (x_max - x_min)/4)
+    plt.close(bgi.fig)
+
+# RunningMetrics, adjusted a slice at a time, checked against bg_metrics() and range_cost() on the whole curve
+
+def assert_metrics_match(running, y):
+    metrics = running.metrics()
+    expected = dict(bg_metrics(y), score=range_cost(y)[0])
+    assert metrics.keys() == expected.keys()
+    for key in expected:
+        np.testing.assert_allclose(metrics[key], expected[key], rtol=1e-9, atol=1e-9, err_msg=key)
+
+def test_running_metrics_match_full_metrics():
+    rng = np.random.default_rng(8)
+    y = 120 + np.cumsum(rng.normal(0, 6, 1000))
+    running = RunningMetrics(y)
+    assert_metrics_match(running, y)
+    for step in range(50):
+        if step % 3 == 0:
+            # new samples, sometimes filling a block exactly
+            y = np.concatenate([y, y[-1] + np.cumsum(rng.normal(0, 6, rng.choice([1, 7, RunningMetrics.block_size])))])
+            running.append(y[np.size(running.y):])
+        else:
+            # a bolus-sized edit: a slice moves up or down, taking the extremes with it
+            lo = rng.integers(np.size(y))
+            hi = lo + rng.integers(1, 300)
+            y = y.copy()
+            y[lo:hi] += rng.normal(0, 40)
+            running.update(y, lo, hi)
+        assert_metrics_match(running, y)